@@ -10,19 +10,34 @@
 import argparse
 import atexit
 import os
+import re
 import readline
+import select
+import selectors
 import socket
 import sys
+import termios
 import time
+import tty
 
 # Requires pyserial.
 import serial
 
 
 PROMPT = ">"
+_PROMPT_B = PROMPT.encode()
+_NL = b"\n"
+_PROMPT_SEQ = _NL + _PROMPT_B
+_PROMPT_RE = re.compile(re.escape(_PROMPT_SEQ))
+_OUT = sys.stdout.buffer
+SOCKET_BUFSIZE = 4 << 20
 
 
 class Interface:
+    def __init__(self):
+        # Output that was read together with a prompt but arrived after it.
+        self.pending = b""
+
     def read(self, size, timeout=0):
         raise NotImplementedError()
 
@@ -33,13 +48,30 @@ class Interface:
         while self.read(1024, timeout=0.1):
             pass
 
+    def fileno(self):
+        return self.dev.fileno()
+
+    def _register_poll(self):
+        self._poll = select.poll()
+        self._poll.register(self.dev, select.POLLIN)
+
+    def _readable(self, timeout):
+        # The device stays in one mode and the deadline is enforced here, so
+        # a read never has to reconfigure the device.
+        return bool(self._poll.poll(timeout * 1000))
+
 
 class SerialInterface(Interface):
     def __init__(self, port, baudrate):
-        self.dev = serial.Serial(port, baudrate)
+        super().__init__()
+        # Non-blocking, so a read returns whatever is already buffered like
+        # recv() does for sockets.
+        self.dev = serial.Serial(port, baudrate, timeout=0)
+        self._register_poll()
 
     def read(self, size, timeout=0):
-        self.dev.timeout = timeout
+        if not self._readable(timeout):
+            return b""
         return self.dev.read(size)
 
     def write(self, data):
@@ -48,45 +80,150 @@ class SerialInterface(Interface):
 
 class SocketInterface(Interface):
     def __init__(self, host, port):
+        super().__init__()
         self.dev = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.dev.connect((host, port))
+        self.dev.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.dev.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFSIZE)
+        self.dev.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFSIZE)
+        self._register_poll()
 
     def read(self, size, timeout=0):
-        self.dev.settimeout(timeout)
-        try:
-            return self.dev.recv(size)
-        except socket.timeout:
+        if not self._readable(timeout):
             return b""
+        return self.dev.recv(size)
 
     def write(self, data):
-        self.dev.send(data)
+        # Batched commands may not fit in a single send().
+        self.dev.sendall(data)
 
 
-def wait_for_response(interface, timeout):
-    start = time.time()
-    found_prompt = False
-    newline = False
-    while True:
-        if (time_left := start + timeout - time.time()) <= 0:
+def wait_for_response(interface, timeout, prompts=1):
+    # Waits for `prompts` prompts, allowing `timeout` seconds for each.
+    # Intermediate prompts are echoed so that batched responses stay apart.
+    deadline = time.monotonic_ns() + int(timeout * 1e9)
+    # Bytes not printed yet because they may be the start of a prompt that
+    # continues in the next chunk.
+    held = b""
+    last = b""
+    while prompts:
+        if (now := time.monotonic_ns()) >= deadline:
             break
-        data = interface.read(1, timeout=time_left)
-        found_prompt = data == PROMPT.encode() and newline
-        if found_prompt or time.time() >= start + timeout:
-            break
-        newline = data == b"\n"
-        sys.stdout.buffer.write(data)
-    if not found_prompt:
-        if not newline:
-            print("")
-        print("Timeout before prompt was found. Perhaps increase timeout?")
+        data = interface.read(4096, timeout=(deadline - now) / 1e9)
+        buf = held + data
+        start = 0
+        while m := _PROMPT_RE.search(buf, start):
+            _OUT.write(buf[start : m.start() + 1])
+            prompts -= 1
+            if not prompts:
+                # A space right after the prompt belongs to the prompt.
+                rest = buf[m.end() :]
+                interface.pending = rest[1:] if rest[:1] == b" " else rest
+                return
+            _OUT.write(_PROMPT_B + b" ")
+            last = b" "
+            start = m.end()
+            deadline = time.monotonic_ns() + int(timeout * 1e9)
+        keep = max(start, len(buf) - len(_PROMPT_SEQ) + 1)
+        if chunk := buf[start:keep]:
+            _OUT.write(chunk)
+            last = chunk[-1:]
+        held = buf[keep:]
+    if held:
+        _OUT.write(held)
+        last = held[-1:]
+    if last != _NL:
+        print("")
+    print("Timeout before prompt was found. Perhaps increase timeout?")
 
 
 def read_available_input(interface):
-    while data := interface.read(1024, timeout=0.1):
-        sys.stdout.buffer.write(data)
+    # Prints what the device has sent without waiting for more and returns
+    # the last byte printed.
+    data, interface.pending = interface.pending, b""
+    last = data[-1:]
+    _OUT.write(data)
+    while data := interface.read(4096):
+        _OUT.write(data)
+        last = data[-1:]
+    _OUT.flush()
+    return last
 
 
-def interactive(interface, timeout):
+def pipe_loop(interface, timeout):
+    # Commands that are already queued on the pipe are sent in one write,
+    # after which we wait for all of their prompts.
+    fd = sys.stdin.fileno()
+    pending = b""
+    while True:
+        _OUT.write(_PROMPT_B + b" ")
+        _OUT.flush()
+        eof = False
+        while _NL not in pending:
+            if not (data := os.read(fd, 65536)):
+                eof = True
+                break
+            pending += data
+        cmds = pending.split(_NL)
+        pending = cmds.pop()
+        if eof and pending:
+            cmds.append(pending)
+        if cmds:
+            read_available_input(interface)
+            interface.write(_NL.join(cmds) + _NL)
+            wait_for_response(interface, timeout, len(cmds))
+        if eof:
+            return
+
+
+def prompt_loop(interface, timeout):
+    # Waits for the user and the device at the same time so that output the
+    # device sends between commands is shown as it arrives. The terminal is
+    # kept in cbreak mode while waiting so that the first key press wakes us
+    # up, after which readline takes over and reads the rest of the line.
+    sel = selectors.DefaultSelector()
+    sel.register(sys.stdin, selectors.EVENT_READ)
+    sel.register(interface, selectors.EVENT_READ)
+    fd = sys.stdin.fileno()
+    mode = termios.tcgetattr(fd)
+    prompt_shown = False
+    partial_line = False
+    try:
+        while True:
+            tty.setcbreak(fd)
+            if not prompt_shown and not partial_line:
+                sys.stdout.write(PROMPT + " ")
+                sys.stdout.flush()
+                prompt_shown = True
+            for key, _ in sel.select():
+                if key.fileobj is sys.stdin:
+                    termios.tcsetattr(fd, termios.TCSADRAIN, mode)
+                    sys.stdout.write("\r" if prompt_shown else "\n")
+                    cmd = input(PROMPT + " ")
+                    # Whatever arrived while readline owned the terminal
+                    # belongs before this command's response.
+                    read_available_input(interface)
+                    interface.write((cmd + "\n").encode())
+                    wait_for_response(interface, timeout)
+                    read_available_input(interface)
+                    # The response ends at the device's prompt, so always
+                    # show ours again.
+                    prompt_shown = partial_line = False
+                    break
+                if prompt_shown:
+                    sys.stdout.write("\r\x1b[K")
+                    sys.stdout.flush()
+                    prompt_shown = False
+                if not (last := read_available_input(interface)):
+                    print("\nConnection closed.")
+                    return
+                # Show the prompt again once the device has finished a line.
+                partial_line = last != _NL
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, mode)
+
+
+def load_history():
     histfile = os.path.join(os.path.expanduser("~"), ".serial_client_history")
     try:
         readline.read_history_file(histfile)
@@ -97,12 +234,20 @@ def interactive(interface, timeout):
     except FileNotFoundError:
         pass
     atexit.register(readline.write_history_file, histfile)
+
+
+def interactive(interface, timeout):
+    tty_input = sys.stdin.isatty()
+    if tty_input:
+        load_history()
+    else:
+        # Scripted use: no line editing, so leave the history file alone.
+        readline.set_auto_history(False)
     try:
-        while True:
-            cmd = input(PROMPT + " ")
-            read_available_input(interface)
-            interface.write((cmd + "\n").encode())
-            wait_for_response(interface, timeout)
+        if tty_input:
+            prompt_loop(interface, timeout)
+        else:
+            pipe_loop(interface, timeout)
     except (EOFError, KeyboardInterrupt):
         pass
     finally:
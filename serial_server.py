@@ -8,29 +8,48 @@
 # Written by Jakob Ruhe
 
 import argparse
+import os
 import socket
-import select
+import selectors
+import signal
 import sys
-import io
+import time
 
 # Requires pip package pyserial
 import serial
 
+SOCKET_BUFSIZE = 4 << 20
+IOV_MAX = os.sysconf("SC_IOV_MAX")
+# Clients that fall further behind than this are disconnected.
+MAX_CLIENT_BACKLOG = 4 << 20
+# Output mirrored to stdout is flushed at most this often, in seconds.
+STDOUT_FLUSH_INTERVAL = 0.1
+
+
+def set_socket_options(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFSIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFSIZE)
+
 
 class LineBuf:
     def __init__(self):
-        self.buf = io.BytesIO()
+        self.buf = bytearray()
+        self._head = 0
 
     def write(self, data):
-        self.buf.write(data)
+        self.buf.extend(data)
 
     def readline(self):
-        data = self.buf.getvalue()
-        pos = data.find(b"\n")
+        pos = self.buf.find(b"\n", self._head)
         if pos == -1:
             return None
-        line = data[0 : pos + 1]
-        self.buf = io.BytesIO(data[pos + 1 :])
+        line = bytes(self.buf[self._head : pos + 1])
+        self._head = pos + 1
+        # Compact only once the consumed part dominates the buffer.
+        if self._head > 4096 and self._head > len(self.buf) // 2:
+            del self.buf[: self._head]
+            self._head = 0
         return line
 
 
@@ -38,29 +57,58 @@ class Client:
     def __init__(self, sock, addr):
         self.sock = sock
         self.addr = addr
+        self.fd = sock.fileno()
         self.buf = LineBuf()
+        self.out = bytearray()
+        self.writable = False
+        self.overflowed = False
+        self._recv_buf = bytearray(4096)
+        self._mv = memoryview(self._recv_buf)
 
     def read(self):
         try:
-            data = self.sock.recv(1024)
+            n = self.sock.recv_into(self._mv)
         except OSError:
             return None
-        if not data:
+        if not n:
             return None
-        self.buf.write(data)
-        return data
+        self.buf.write(self._mv[:n])
+        return n
 
     def readline(self):
         return self.buf.readline()
 
     def write(self, data):
+        # Send straight from the shared chunk when nothing is queued and only
+        # copy the part the socket did not accept. Returns True if the
+        # selector interest for this client has to be updated.
+        if not self.out:
+            try:
+                n = self.sock.send(data)
+            except BlockingIOError:
+                n = 0
+            except OSError:
+                return False
+            data = memoryview(data)[n:]
+        if len(self.out) + len(data) > MAX_CLIENT_BACKLOG:
+            self.overflowed = True
+            self.out.clear()
+            return True
+        self.out.extend(data)
+        return bool(self.out) != self.writable
+
+    def flush(self):
         try:
-            self.sock.send(data)
+            n = self.sock.send(memoryview(self.out))
+        except BlockingIOError:
+            return
         except OSError:
-            pass
+            # The disconnect is noticed on the next read.
+            n = len(self.out)
+        del self.out[:n]
 
     def fileno(self):
-        return self.sock.fileno()
+        return self.fd
 
     def close(self):
         self.sock.close()
@@ -69,12 +117,21 @@ class Client:
 class Serial:
     def __init__(self, dev):
         self.dev = dev
+        self.dev.timeout = 0
+        self.fd = dev.fileno()
         self.buf = LineBuf()
 
     def read(self):
-        data = self.dev.read()
-        if not data:
+        # Only called when the selector reports the device as readable, so a
+        # single read drains whatever the kernel has buffered.
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
             return None
+        if not data:
+            raise serial.SerialException(
+                "device reports readiness to read but returned no data"
+            )
         self.buf.write(data)
         return data
 
@@ -84,45 +141,133 @@ class Serial:
     def write(self, data):
         self.dev.write(data)
 
+    def writelines(self, lines):
+        for i in range(0, len(lines), IOV_MAX):
+            iov = lines[i : i + IOV_MAX]
+            try:
+                n = os.writev(self.fd, iov)
+            except BlockingIOError:
+                n = 0
+            # Let pyserial wait for the device to accept a partial write.
+            if n < sum(len(line) for line in iov):
+                self.dev.write(b"".join(iov)[n:])
+
     def fileno(self):
-        return self.dev.fileno()
+        return self.fd
 
 
-def process_serial(clients, ser):
+class LogFile:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def write(self, data):
+        if self.fd is None:
+            return
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self.fd, view) :]
+        except OSError as e:
+            # Losing the log file must not take the port away from clients.
+            print(f"Stopped logging to '{self.path}': {e}", file=sys.stderr)
+            os.close(self.fd)
+            self.fd = None
+
+
+def process_serial(clients, ser, log):
     data = ser.read()
+    if not data:
+        return []
+    if log is not None:
+        log.write(data)
     sys.stdout.write(data.decode("utf-8", "backslashreplace"))
-    for c in clients.values():
-        c.write(data)
+    return [c for c in clients if c.write(data)]
 
 
 def process_clients(clients, ser):
     remove_clients = []
+    lines = []
     for c in clients:
-        data = c.read()
-        if not data:
+        if not c.read():
             remove_clients.append(c)
             continue
         while line := c.readline():
-            ser.write(line)
+            lines.append(line)
+    ser.writelines(lines)
     return remove_clients
 
 
-def run(ser, serversocket):
-    clients = {}
+def update_client_events(sel, c):
+    # Only ask for write readiness while there is queued output.
+    writable = bool(c.out)
+    if writable != c.writable:
+        events = selectors.EVENT_READ
+        if writable:
+            events |= selectors.EVENT_WRITE
+        sel.modify(c, events, c)
+        c.writable = writable
+
+
+def remove_client(sel, clients, c):
+    sel.unregister(c)
+    clients.remove(c)
+    c.close()
+
+
+def run(ser, serversocket, log=None):
+    clients = set()
+    sel = selectors.DefaultSelector()
+    sel.register(serversocket, selectors.EVENT_READ, serversocket)
+    sel.register(ser, selectors.EVENT_READ, ser)
+    flush_at = None
     while True:
-        fds = [serversocket.fileno(), ser.fileno()]
-        for c in clients.values():
-            fds.append(c.sock.fileno())
-        r, w, x = select.select(fds, [], [])
-        if serversocket.fileno() in r:
-            sock, addr = serversocket.accept()
-            clients[sock.fileno()] = Client(sock, addr)
-        if ser.fileno() in r:
-            process_serial(clients, ser)
-        ready_clients = [c for fd, c in clients.items() if fd in r]
+        timeout = None
+        if flush_at is not None:
+            timeout = max(0, flush_at - time.monotonic())
+        ready_clients = []
+        overflowed_clients = []
+        for key, events in sel.select(timeout):
+            if key.data is serversocket:
+                sock, addr = serversocket.accept()
+                set_socket_options(sock)
+                sock.setblocking(False)
+                c = Client(sock, addr)
+                clients.add(c)
+                sel.register(c, selectors.EVENT_READ, c)
+            elif key.data is ser:
+                if flush_at is None:
+                    flush_at = time.monotonic() + STDOUT_FLUSH_INTERVAL
+                for c in process_serial(clients, ser, log):
+                    if c.overflowed:
+                        overflowed_clients.append(c)
+                    else:
+                        update_client_events(sel, c)
+            elif key.data.overflowed:
+                # Removed after this batch, together with the others.
+                continue
+            else:
+                if events & selectors.EVENT_WRITE:
+                    key.data.flush()
+                    update_client_events(sel, key.data)
+                if events & selectors.EVENT_READ:
+                    ready_clients.append(key.data)
         remove_clients = process_clients(ready_clients, ser)
+        for c in overflowed_clients:
+            host, port = c.addr[:2]
+            print(f"Disconnecting {host}:{port}, it is not reading.", file=sys.stderr)
+            if c not in remove_clients:
+                remove_clients.append(c)
         for c in remove_clients:
-            del clients[c.fileno()]
+            remove_client(sel, clients, c)
+        if flush_at is not None and time.monotonic() >= flush_at:
+            sys.stdout.flush()
+            flush_at = None
+
+
+def handle_sigterm(signum, frame):
+    # Unwind normally so that buffered stdout is flushed on `systemctl stop`.
+    raise SystemExit(0)
 
 
 def parse_args():
@@ -151,6 +296,19 @@ def parse_args():
         default=5555,
         help="Port to listen for connections on",
     )
+    parser.add_argument(
+        "--log",
+        metavar="PATH",
+        help="Also append everything read from the serial device to this file",
+    )
+    parser.add_argument(
+        "--line-buffered",
+        action="store_true",
+        help=(
+            "Flush stdout after every line instead of at most every "
+            f"{STDOUT_FLUSH_INTERVAL} seconds"
+        ),
+    )
     return parser.parse_args()
 
 
@@ -159,13 +317,19 @@ def main():
     ser = Serial(serial.Serial(args.device, args.baudrate))
     serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    set_socket_options(serversocket)
     serversocket.bind((args.bind, args.port))
     serversocket.listen()
-    sys.stdout.reconfigure(line_buffering=True)
+    if args.line_buffered:
+        sys.stdout.reconfigure(line_buffering=True)
+    log = LogFile(args.log) if args.log else None
+    signal.signal(signal.SIGTERM, handle_sigterm)
     try:
-        run(ser, serversocket)
+        run(ser, serversocket, log)
     except KeyboardInterrupt:
         pass
+    finally:
+        sys.stdout.flush()
 
 
 if __name__ == "__main__":